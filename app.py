@@ -1,17 +1,26 @@
 # app.py — Milk Digitalization v2.1 (Clean design, no emojis)
-# Требует: pandas, numpy, streamlit, matplotlib, seaborn  (sklearn — опционально)
+# Требует: pandas, numpy, pyarrow, streamlit, matplotlib, seaborn  (sklearn, polars — опционально)
 
-import json
+import codecs
+import csv
+import itertools
 import io
+import json
+import re
+import tempfile
 import zipfile
-import base64
 from pathlib import Path
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import streamlit as st
+import matplotlib
+matplotlib.use("Agg")  # без GUI-бэкенда: графики только рендерятся в PNG
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sns
 
 # Try to import sklearn (optional but recommended)
@@ -23,6 +32,17 @@ try:
 except Exception:
     SKLEARN = False
 
+# copy-on-write: в pandas >= 3 включён всегда (опция устарела), в 2.x включаем сами
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+# Try to import polars (optional, faster CSV parsing)
+try:
+    import polars as pl
+    POLARS = True
+except Exception:
+    POLARS = False
+
 # ---------------------------
 # --- Настройки путей ---
 # ---------------------------
@@ -38,30 +58,152 @@ MEASUREMENTS_CSV = DATA_DIR / "Measurements.csv"
 VITAMINS_CSV = DATA_DIR / "Vitamins_AminoAcids.csv"
 STORAGE_CSV = DATA_DIR / "Storage_Conditions.csv"
 NORMS_JSON = DATA_DIR / "process_norms.json"
+# файлы отсюда Streamlit раздаёт по /app/static/ (см. .streamlit/config.toml)
+STATIC_DIR = Path(__file__).parent / "static"
 
 # ---------------------------
 # --- Утилиты ---
 # ---------------------------
-def safe_read_csv(path: Path) -> pd.DataFrame:
+def _read_csv_arrow(path: Path, encoding: str, dtypes=None) -> pd.DataFrame:
+    """Парсинг CSV через PyArrow (многопоточный C++), колонки — Arrow-типы."""
+    table = pa_csv.read_csv(
+        path,
+        read_options=pa_csv.ReadOptions(encoding=encoding),
+        convert_options=pa_csv.ConvertOptions(column_types=dtypes or {}),
+    )
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+def _read_csv_polars(path: Path, dtypes=None) -> pd.DataFrame:
+    """Парсинг CSV через Polars (только UTF-8); короткие строки дополняются null."""
+    # та же схема, что и для pyarrow: pa-тип -> polars-тип; колонок, которых нет в файле, polars не требует
+    overrides = {col: pl.from_arrow(pa.array([], type=typ)).dtype for col, typ in (dtypes or {}).items()}
+    table = pl.read_csv(path, infer_schema_length=1000, schema_overrides=overrides).to_arrow()
+    # polars отдаёт large_string, pyarrow и pandas — string: приводим к одному типу
+    schema = pa.schema([f.with_type(pa.string()) if pa.types.is_large_string(f.type) else f for f in table.schema])
+    return table.cast(schema).to_pandas(types_mapper=pd.ArrowDtype)
+
+def _coerce_dtypes(df: pd.DataFrame, dtypes) -> pd.DataFrame:
+    for col, typ in (dtypes or {}).items():
+        if col in df.columns and df[col].dtype != pd.ArrowDtype(typ):
+            # мусор, пропуски (NaN из polars/pandas), дробные и не влезающие в тип значения -> NA,
+            # а не ошибка приведения
+            num = pd.to_numeric(df[col], errors='coerce', dtype_backend='pyarrow').astype(pd.ArrowDtype(pa.float64()))
+            ok = num.round() == num
+            if pa.types.is_integer(typ):
+                lim = np.iinfo(typ.to_pandas_dtype())
+                ok &= num.between(lim.min, lim.max)
+            df[col] = num.where(ok).astype(pd.ArrowDtype(typ))
+    return df
+
+def _sniff_encoding(path: Path) -> str:
+    """UTF-8 (BOM pyarrow снимает сам) или cp1251 — по первым 64 КБ, чтобы не парсить файл дважды."""
+    with open(path, "rb") as f:
+        head = f.read(65536)
+    try:
+        # инкрементальный декодер не считает ошибкой символ, обрезанный на границе 64 КБ
+        codecs.getincrementaldecoder("utf-8")().decode(head)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1251"
+
+def safe_read_csv(path: Path, dtypes=None) -> pd.DataFrame:
+    """dtypes: {колонка: pyarrow-тип} для числовых колонок; отсутствующие в файле игнорируются."""
     if not path.exists():
         return pd.DataFrame()
+    encoding = _sniff_encoding(path)
     try:
-        df = pd.read_csv(path, encoding="utf-8-sig")
+        if POLARS and encoding == "utf-8":
+            df = _read_csv_polars(path, dtypes)
+        else:
+            df = _read_csv_arrow(path, encoding, dtypes)
     except Exception:
-        df = pd.read_csv(path, encoding="latin1")
+        # строки с неполным числом полей (или мусор в id) pyarrow не принимает —
+        # C-парсер pandas их дополняет, типы приводим с coerce
+        try:
+            df = pd.read_csv(path, encoding="utf-8-sig" if encoding == "utf-8" else encoding,
+                             dtype_backend="pyarrow")
+        except UnicodeDecodeError:
+            # первые 64 КБ были чистым ASCII, а дальше — cp1251
+            df = pd.read_csv(path, encoding="cp1251", dtype_backend="pyarrow")
     if not df.empty:
-        df.columns = [str(c).strip() for c in df.columns]
+        df = df.rename(columns=lambda c: str(c).strip())
+    # после pyarrow типы уже нужные — проход только для polars/pandas-веток
+    return _coerce_dtypes(df, dtypes)
+
+# версия формата копии: увеличивать при любом изменении _prepare_* или *_DTYPES,
+# иначе свежая по mtime копия старого формата будет отдаваться как есть
+SIDECAR_VERSION = 2
+
+def parquet_sidecar(path_csv: Path) -> Path:
+    return path_csv.with_name(f"{path_csv.stem}.v{SIDECAR_VERSION}.parquet")
+
+def _load_or_cache(path_csv: Path, dtypes=None, prepare=None) -> pd.DataFrame:
+    """Читаем Parquet-копию, если она свежее CSV; иначе парсим CSV, готовим (prepare) и сохраняем копию."""
+    path_parquet = parquet_sidecar(path_csv)
+    if not path_csv.exists():
+        return prepare(pd.DataFrame()) if prepare else pd.DataFrame()
+    if path_parquet.exists() and path_parquet.stat().st_mtime_ns > path_csv.stat().st_mtime_ns:
+        try:
+            # копия могла быть записана со старой схемой — приводим типы (no-op, если совпадают)
+            return _coerce_dtypes(pd.read_parquet(path_parquet, engine="pyarrow", dtype_backend="pyarrow"), dtypes)
+        except Exception:
+            pass
+    df = safe_read_csv(path_csv, dtypes)
+    if prepare:
+        # схема задана каноническими именами — после prepare (_normalize_columns)
+        # типизируются и колонки, пришедшие под синонимами (product, sample, id...)
+        df = _coerce_dtypes(prepare(df), dtypes)
+    if not df.empty:
+        try:
+            df.to_parquet(path_parquet, engine="pyarrow", compression="zstd", index=False)
+        except Exception:
+            pass
     return df
 
-def append_row_csv(path: Path, row: dict, cols_order=None):
-    df_new = pd.DataFrame([row])
+def _csv_encoding(path: Path) -> str:
+    """Кодировка для чтения заголовка и дозаписи: как у файла (cp1251 остаётся cp1251), новый — UTF-8 с BOM."""
+    if path.exists() and path.stat().st_size > 0 and _sniff_encoding(path) == "cp1251":
+        return "cp1251"
+    return "utf-8-sig"
+
+def csv_header(path: Path, default):
+    """Колонки существующего CSV (чтобы дописываемые строки ложились в свои столбцы) или default."""
+    if path.exists() and path.stat().st_size > 0:
+        with open(path, newline="", encoding=_csv_encoding(path)) as f:
+            header = next(csv.reader(f), None)
+        if header:
+            return header
+    return list(default)
+
+def append_row_csv(path: Path, rows, cols_order):
+    """Дописывает строку (dict) или список строк; столбцы — по заголовку файла, cols_order — для нового файла."""
+    if isinstance(rows, dict):
+        rows = [rows]
     write_header = not path.exists() or path.stat().st_size == 0
-    if cols_order:
-        for c in cols_order:
-            if c not in df_new.columns:
-                df_new[c] = ""
-        df_new = df_new[cols_order]
-    df_new.to_csv(path, mode='a', index=False, header=write_header, encoding='utf-8-sig')
+    fieldnames = csv_header(path, cols_order)
+    # BOM в режиме "a" пишется только в пустой файл
+    with open(path, "a", newline="", encoding=_csv_encoding(path), buffering=1 << 16) as f:
+        w = csv.DictWriter(f, fieldnames=fieldnames, restval="", extrasaction="ignore", lineterminator="\n")
+        if write_header:
+            w.writeheader()
+        w.writerows(rows)
+
+_CLEAN_RE = re.compile(r" |±.*$")
+_EXP_RE = re.compile(r"[×x]10\^?")
+# как в исходном посимвольном цикле: ведущие цифры и .-+eE, дальше — float (или NaN);
+# вторая группа — следующий символ, чтобы поймать не-ASCII цифры (⁵, ١), которые цикл тоже брал
+_NUM_PREFIX_RE = re.compile(r"^([0-9.+\-eE]*)(.?)")
+
+def _float_prefix(s: str) -> float:
+    """Префикс из символов с str.isdigit() и .-+eE -> float; ровно как исходный цикл."""
+    end = _NUM_PREFIX_RE.match(s).end(1)
+    while end < len(s) and (s[end].isdigit() or s[end] in ".-+eE"):
+        end += 1
+    try:
+        # "10⁵" -> float падает -> NaN; "١٢" -> 12.0
+        return float(s[:end])
+    except ValueError:
+        return np.nan
 
 def parse_numeric(val):
     """Аккуратно парсим числа: поддержка запятых, ±, x10^, etc."""
@@ -72,39 +214,69 @@ def parse_numeric(val):
     s = str(val).strip()
     if s == "" or "не обнаруж" in s.lower():
         return np.nan
-    s = s.replace(' ', '').replace(',', '.')
-    s = s.replace('×10^', 'e').replace('x10^', 'e')
-    s = s.replace('×10', 'e').replace('x10', 'e').replace('×', '')
-    if '±' in s:
-        s = s.split('±')[0]
-    cleaned = ''
-    for ch in s:
-        if ch.isdigit() or ch in '.-+eE':
-            cleaned += ch
-        else:
-            break
+    return _float_prefix(_EXP_RE.sub("e", _CLEAN_RE.sub("", s.replace(",", "."))).replace("×", ""))
+
+def _parse_numeric_strings(values: pd.Series) -> pd.Series:
+    s = values.astype("string").str.strip()
+    not_found = s.str.lower().str.contains("не обнаруж", regex=False, na=False)
+    s = (s.str.replace(",", ".", regex=False)
+          .str.replace(_CLEAN_RE, "", regex=True)
+          .str.replace(_EXP_RE, "e", regex=True)
+          .str.replace("×", "", regex=False))
+    parts = s.str.extract(_NUM_PREFIX_RE)
+    result = pd.to_numeric(parts[0], errors="coerce").astype("float64")
+    # за ASCII-префиксом идёт не-ASCII цифра — редкий случай, разбираем поштучно
+    odd = parts[1].fillna("").map(str.isdigit).astype(bool)
+    if odd.any():
+        result = result.where(~odd, s[odd].map(_float_prefix).astype("float64"))
+    return result.where(~not_found)
+
+def parse_numeric_series(values: pd.Series) -> pd.Series:
+    """Векторная версия parse_numeric для целой колонки."""
+    # обычно значения уже чистые числа — строковый пайплайн только для остатка
+    result = pd.to_numeric(values, errors="coerce").astype("float64")
+    need = result.isna() & values.notna()
+    if not pd.api.types.is_numeric_dtype(values):
+        # to_numeric понимает "inf"/"nan"/"Infinity" — посимвольный разбор их не принимает
+        need |= ~np.isfinite(result)
+    if need.any():
+        # where, а не присваивание по маске: буфер после Arrow может быть read-only
+        result = result.where(~need, _parse_numeric_strings(values[need]))
+    return result
+
+# один архив в кеше: при изменении CSV старый блоб вытесняется, а не копится
+@st.cache_data(show_spinner=False, max_entries=1)
+def _build_zip(stamps: tuple) -> bytes:
+    """stamps = ((путь, mtime_ns, size), ...) — архив пересобирается только при изменении файлов.
+    Пишем во временный файл (без перевыделений BytesIO) и читаем его целиком один раз."""
+    with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp:
+        tmp_path = Path(tmp.name)
+        with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED, compresslevel=3) as z:
+            for p, _, _ in stamps:
+                z.write(p, arcname=Path(p).name)
     try:
-        return float(cleaned)
-    except Exception:
-        return np.nan
+        return tmp_path.read_bytes()
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
 def download_zip(paths, filename="Milk_Digitalization_all_csv.zip"):
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w") as z:
-        for p in paths:
-            if Path(p).exists():
-                z.write(p, arcname=Path(p).name)
-    buf.seek(0)
-    st.download_button("Скачать ZIP", data=buf, file_name=filename, mime="application/zip")
+    stamps = []
+    for p in map(Path, paths):
+        if p.exists():
+            stat = p.stat()
+            stamps.append((str(p), stat.st_mtime_ns, stat.st_size))
+    st.download_button("Скачать ZIP", data=_build_zip(tuple(stamps)), file_name=filename, mime="application/zip")
 
 def embed_pdf(path: Path):
+    """PDF отдаёт статика Streamlit (./static, server.enableStaticServing) — без base64 в HTML."""
     if not path.exists():
         st.warning("PDF файл не найден.")
         return
-    b = path.read_bytes()
-    b64 = base64.b64encode(b).decode('utf-8')
-    html = f'<iframe src="data:application/pdf;base64,{b64}" width="100%" height="600"></iframe>'
-    st.components.v1.html(html, height=600, scrolling=True)
+    if path.parent.resolve() == STATIC_DIR.resolve():
+        st.markdown(f'<iframe src="./app/static/{path.name}" width="100%" height="600"></iframe>', unsafe_allow_html=True)
+    else:
+        st.caption("Просмотр доступен для PDF из папки static — файл можно скачать ниже.")
+    st.download_button("Скачать PDF", data=path.read_bytes(), file_name=path.name, mime="application/pdf")
 
 # ---------------------------
 # --- Автогенерация демо CSV (если нет файлов) ---
@@ -147,78 +319,136 @@ _ensure_demo_csvs()
 # ---------------------------
 # --- Кеш загрузки данных ---
 # ---------------------------
-@st.cache_data
-def load_csvs():
-    products = safe_read_csv(PRODUCTS_CSV)
-    samples = safe_read_csv(SAMPLES_CSV)
-    measurements = safe_read_csv(MEASUREMENTS_CSV)
-    vitamins = safe_read_csv(VITAMINS_CSV)
-    storage = safe_read_csv(STORAGE_CSV)
-    return products, samples, measurements, vitamins, storage
-
-products, samples, measurements, vitamins, storage = load_csvs()
-
-# helper to normalize column names
-def ensure_col(df, candidates, new_name):
+# Streamlit выполняет модуль заново на каждом rerun, поэтому всё, что не зависит от ввода
+# (таблицы, каталог этапов, поля форм, данные и графики аналитики), строим под st.cache_* один раз
+# id-колонки сразу читаем как целые — без отдельного прохода pd.to_numeric
+# id помещаются в int32, сроки хранения — в int16; id измерений — int64 (в старых данных есть id от timestamp)
+PRODUCT_DTYPES = {"product_id": pa.int32()}
+SAMPLE_DTYPES = {"sample_id": pa.int32(), "product_id": pa.int32(), "storage_days": pa.int16()}
+MEASUREMENT_DTYPES = {"id": pa.int64(), "sample_id": pa.int32()}
+STORAGE_DTYPES = {"id": pa.int32(), "sample_id": pa.int32(), "duration_days": pa.int16()}
+
+# helper to normalize column names: {целевое имя: [варианты в CSV]}
+def _normalize_columns(df, spec):
     if df.empty:
-        return df, None
+        return df
+    lowered = {}
     for col in df.columns:
+        lowered.setdefault(str(col).strip().lower(), col)
+    mapping = {}
+    for target, candidates in spec.items():
         for cand in candidates:
-            if str(col).strip().lower() == str(cand).strip().lower():
-                return df.rename(columns={col: new_name}), new_name
-    return df, None
-
-# normalize product columns
-products, _ = ensure_col(products, ["product_id","id"], "product_id")
-products, _ = ensure_col(products, ["name","product_name","title"], "name")
-products, _ = ensure_col(products, ["type","category"], "type")
-products, _ = ensure_col(products, ["source"], "source")
-products, _ = ensure_col(products, ["description"], "description")
-
-# normalize samples columns
-samples, _ = ensure_col(samples, ["sample_id","id"], "sample_id")
-samples, _ = ensure_col(samples, ["product_id","product"], "product_id")
-samples, _ = ensure_col(samples, ["reg_number"], "reg_number")
-samples, _ = ensure_col(samples, ["date_received","date"], "date_received")
-samples, _ = ensure_col(samples, ["storage_days","duration_days"], "storage_days")
-samples, _ = ensure_col(samples, ["conditions"], "conditions")
-samples, _ = ensure_col(samples, ["notes"], "notes")
-
-# normalize measurement columns
-measurements, _ = ensure_col(measurements, ["id"], "id")
-measurements, _ = ensure_col(measurements, ["sample_id","sample"], "sample_id")
-measurements, _ = ensure_col(measurements, ["parameter","param","indicator"], "parameter")
-measurements, _ = ensure_col(measurements, ["actual_value","value","measurement"], "actual_value")
-measurements, _ = ensure_col(measurements, ["unit"], "unit")
-measurements, _ = ensure_col(measurements, ["method"], "method")
-
-# storage
-storage, _ = ensure_col(storage, ["sample_id"], "sample_id")
-storage, _ = ensure_col(storage, ["temperature_C","temperature_c","temp"], "temperature_C")
-storage, _ = ensure_col(storage, ["humidity_pct","humidity"], "humidity_pct")
-storage, _ = ensure_col(storage, ["duration_days"], "duration_days")
-
-# to int-like
-def to_intlike(df, col):
-    if col in df.columns:
-        df[col] = pd.to_numeric(df[col], errors='coerce').astype("Int64")
+            col = lowered.get(cand.lower())
+            if col is not None and col not in mapping:
+                mapping[col] = target
+                break
+    return df.rename(columns=mapping)
+
+PRODUCT_COLUMNS = {
+    "product_id": ["product_id","id"],
+    "name": ["name","product_name","title"],
+    "type": ["type","category"],
+    "source": ["source"],
+    "description": ["description"],
+}
+SAMPLE_COLUMNS = {
+    "sample_id": ["sample_id","id"],
+    "product_id": ["product_id","product"],
+    "reg_number": ["reg_number"],
+    "date_received": ["date_received","date"],
+    "storage_days": ["storage_days","duration_days"],
+    "conditions": ["conditions"],
+    "notes": ["notes"],
+}
+MEASUREMENT_COLUMNS = {
+    "id": ["id"],
+    "sample_id": ["sample_id","sample"],
+    "parameter": ["parameter","param","indicator"],
+    "actual_value": ["actual_value","value","measurement"],
+    "unit": ["unit"],
+    "method": ["method"],
+}
+STORAGE_COLUMNS = {
+    "sample_id": ["sample_id"],
+    "temperature_C": ["temperature_C","temperature_c","temp"],
+    "humidity_pct": ["humidity_pct","humidity"],
+    "duration_days": ["duration_days"],
+}
+
+# подготовка по таблицам — результат попадает в Parquet-копию,
+# так что actual_numeric и даты считаются один раз на версию CSV
+def _prepare_products(df):
+    return _normalize_columns(df, PRODUCT_COLUMNS)
+
+def _prepare_samples(df):
+    df = _normalize_columns(df, SAMPLE_COLUMNS)
+    # parse dates
+    if 'date_received' in df.columns:
+        # один тип при любом ридере и при чтении Parquet-копии: timestamp[ms] в Arrow
+        df['date_received'] = pd.to_datetime(df['date_received'], errors='coerce').astype(pd.ArrowDtype(pa.timestamp("ms")))
     return df
 
-products = to_intlike(products, "product_id")
-samples = to_intlike(samples, "sample_id")
-samples = to_intlike(samples, "product_id")
-measurements = to_intlike(measurements, "sample_id")
-storage = to_intlike(storage, "sample_id")
+def _prepare_measurements(df):
+    df = _normalize_columns(df, MEASUREMENT_COLUMNS)
+    # numeric measurements
+    if 'actual_value' in df.columns:
+        df['actual_numeric'] = parse_numeric_series(df['actual_value']).astype(pd.ArrowDtype(pa.float64()))
+    else:
+        df['actual_numeric'] = pd.Series(np.nan, index=df.index).astype(pd.ArrowDtype(pa.float64()))
+    return df
 
-# numeric measurements
-if 'actual_value' in measurements.columns:
-    measurements['actual_numeric'] = measurements['actual_value'].apply(parse_numeric)
-else:
-    measurements['actual_numeric'] = np.nan
+def _prepare_storage(df):
+    return _normalize_columns(df, STORAGE_COLUMNS)
+
+def _to_category(df, cols):
+    # повторяющиеся строковые значения -> category (int-коды + словарь)
+    for col in cols:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+# по таблице на кеш: после сохранения сбрасываем только изменившийся файл (load_samples.clear() и т.п.)
+@st.cache_data
+def load_products():
+    products = _to_category(_load_or_cache(PRODUCTS_CSV, PRODUCT_DTYPES, _prepare_products), ["type","source"])
+    # products по product_id (первая запись на id) — для выборки карточек без сканов
+    if 'product_id' in products.columns:
+        products_indexed = products.drop_duplicates("product_id").set_index("product_id", drop=False)
+    else:
+        products_indexed = pd.DataFrame()
+    return products, products_indexed
+
+@st.cache_data
+def load_samples():
+    samples = _to_category(_load_or_cache(SAMPLES_CSV, SAMPLE_DTYPES, _prepare_samples), ["conditions"])
+    # позиционные индексы: product_id -> строки samples
+    samples_idx_by_product = samples.groupby("product_id").indices if 'product_id' in samples.columns else {}
+    # следующий sample_id считаем здесь: кеш общий для всех сессий и сбрасывается при каждом сохранении
+    mx = samples['sample_id'].max() if 'sample_id' in samples.columns else None
+    next_sample_id = (0 if pd.isna(mx) else int(mx)) + 1
+    return samples, samples_idx_by_product, next_sample_id
+
+@st.cache_data
+def load_measurements():
+    measurements = _to_category(_load_or_cache(MEASUREMENTS_CSV, MEASUREMENT_DTYPES, _prepare_measurements),
+                                ["category","parameter","unit","method"])
+    # sample_id -> строки measurements
+    meas_idx_by_sample = measurements.groupby("sample_id").indices if 'sample_id' in measurements.columns else {}
+    return measurements, meas_idx_by_sample
+
+@st.cache_data
+def load_vitamins():
+    return _load_or_cache(VITAMINS_CSV)
+
+@st.cache_data
+def load_storage():
+    return _load_or_cache(STORAGE_CSV, STORAGE_DTYPES, _prepare_storage)
 
-# parse dates
-if 'date_received' in samples.columns:
-    samples['date_received'] = pd.to_datetime(samples['date_received'], errors='coerce')
+products, products_indexed = load_products()
+samples, samples_idx_by_product, next_sample_id = load_samples()
+measurements, meas_idx_by_sample = load_measurements()
+vitamins = load_vitamins()
+storage = load_storage()
 
 # ---------------------------
 # --- Нормы (process_norms.json) ---
@@ -228,13 +458,160 @@ default_norms = {
     "Охлаждение": {"min":2.0, "max":6.0, "unit":"°C", "note":"Хранение/охлаждение."},
     "Ферментация": {"min":18.0, "max":42.0, "unit":"°C", "note":"Температуры ферментации — зависят от рецептуры."}
 }
-if NORMS_JSON.exists():
-    try:
-        norms = json.loads(NORMS_JSON.read_text(encoding='utf-8'))
-    except Exception:
-        norms = default_norms
-else:
-    norms = default_norms
+
+@st.cache_resource
+def _load_norms():
+    if NORMS_JSON.exists():
+        try:
+            return json.loads(NORMS_JSON.read_text(encoding='utf-8'))
+        except Exception:
+            return default_norms
+    return default_norms
+
+norms = _load_norms()
+
+# ---------------------------
+# --- Этапы процесса по продукту ---
+# ---------------------------
+def _stage(id, label, desc="", norm=None):
+    return (id, label, desc, norm or {})
+
+# --- Правильная логика этапов по продукту (с учётом source) ---
+def _product_steps(prod: dict):
+    name = str(prod.get('name', '')).strip()
+    source = str(prod.get('source', '')).strip()
+
+    nlow = name.lower()
+    slow = source.lower()
+
+    is_ayran  = "айран" in nlow
+    is_cheese = ("ірімшік" in nlow) or ("сыр" in nlow)
+    is_milk   = ("молоко" in nlow)
+
+    goat = (
+        ("козье" in nlow) or ("козий" in nlow) or ("goat" in nlow) or ("ешкі" in nlow) or
+        ("козье" in slow) or ("козий" in slow) or ("goat" in slow) or ("ешкі" in slow)
+    )
+
+    common = [
+        _stage("accept", "Приёмка сырья", "Осмотр тары, органолептика, экспресс-анализ состава/обсеменённости."),
+        _stage("clarify", "Очистка и сортировка (4–6 °C)", "Фильтрация/сепараторы. Оценка чистоты, кислотности (°Т), определение сорта.",
+               {"min": 4, "max": 6, "unit": "°C", "note": "Охлаждение до 4–6 °C замедляет рост бактерий"}),
+        _stage("normalization", "Нормализация состава", "Приведение к нормам по жирности/белку/витаминам/минералам."),
+    ]
+
+    need_homogenization = (is_ayran or (is_milk and not goat) or (is_cheese and not goat))
+    if need_homogenization:
+        common.append(_stage("homogenization", "Гомогенизация", "Дробление жировых шариков → однородность, отсутствие отстоя."))
+
+    common.append(_stage(
+        "pasteurization", "Пастеризация (65–69 °C)", "Термообработка для снижения микрофлоры.",
+        {"min": 65, "max": 69, "unit": "°C", "note": "Пастеризация согласно рецептуре/ГОСТ"}
+    ))
+
+    if is_ayran:
+        tail = [
+            _stage("cool_to_inoc", "Охлаждение до заквашивания (35–45 °C)", "Перед внесением закваски.", {"min": 35, "max": 45, "unit": "°C"}),
+            _stage("inoculation", "Внесение закваски", "Культуры: стрептококк, болгарская палочка, дрожжи."),
+            _stage("fermentation", "Сквашивание (20–25 °C)", "Выдержка при заданной температуре.", {"min": 20, "max": 25, "unit": "°C"}),
+            _stage("salt", "Добавление соли (1.5–2%)", "Перемешать до однородности."),
+            _stage("mix_water", "Смешивание с водой / газирование", "Смешивание с кипячёной водой, газирование."),
+            _stage("mature", "Созревание в бутылках (холод)", "Холодильное созревание."),
+            _stage("label", "Розлив/упаковка/маркировка", "Готовый продукт."),
+        ]
+    elif is_cheese:
+        tail = [
+            _stage("prep_cheese", "Подготовка к выработке", "Коррекция состава/кальций/закваски."),
+            _stage("rennet", "Сычужное свертывание", "Внесение фермента → образование сгустка."),
+            _stage("curd", "Обработка сгустка", "Резка/нагрев/перемешивание → выделение сыворотки."),
+            _stage("form", "Формование", "Выкладка в формы."),
+            _stage("press", "Самопрессование/прессование", "Осушка и уплотнение структуры."),
+            _stage("salt_dry", "Посолка/обсушка", "Рассол/сухая посолка; обсушка 2–3 суток (10–12 °C)."),
+            _stage("ripen", "Созревание", "Камеры с контролем температуры и влажности."),
+            _stage("label", "Упаковка/хранение/реализация", "Контроль качества и выпуск."),
+        ]
+    else:
+        tail = [
+            _stage("cooling", "Охлаждение (2–6 °C)", "Быстрое охлаждение после пастеризации.", {"min": 2, "max": 6, "unit": "°C"}),
+            _stage("steril", "Стерилизация / UHT", "Безопасность и длительный срок хранения."),
+            _stage("label", "Розлив/упаковка/маркировка", "Готовый продукт."),
+        ]
+
+    return common + tail
+
+# шаги зависят только от (id, name, source) — кешируем по этим примитивам
+@st.cache_data
+def _product_steps_cached(pid: int, name: str, source: str):
+    return _product_steps({"product_id": pid, "name": name, "source": source})
+
+# ---------- Исходные продукты ----------
+FIXED_PRODUCTS = [
+    {"product_id": 1, "name": "Молоко (коровье)",       "type": "Молоко",        "source": "Коровье", "description": "Свежее пастеризованное молоко"},
+    {"product_id": 2, "name": "Молоко (козье)",         "type": "Молоко",        "source": "Козье",   "description": "Натуральное фермерское козье молоко"},
+    {"product_id": 3, "name": "Сары ірімшік (коровье)", "type": "Сыр",           "source": "Коровье", "description": "Твёрдый сыр традиционной выработки"},
+    {"product_id": 4, "name": "Сары ірімшік (козье)",   "type": "Сыр",           "source": "Козье",   "description": "Твёрдый сыр из козьего молока"},
+    {"product_id": 5, "name": "Айран",                  "type": "Кисломолочный", "source": "Коровье", "description": "Освежающий кисломолочный продукт"},
+]
+
+# каталог фиксирован — этапы для него строим один раз
+@st.cache_resource(show_spinner=False)
+def steps_by_pid():
+    return {p["product_id"]: tuple(_product_steps(p)) for p in FIXED_PRODUCTS}
+
+def _compile_field(f):
+    """(key, type, name, unit, options, default_idx, default) — всё, что нужно виджету, без .get/.index на rerun."""
+    t = f.get("type", "text")
+    opts = f.get("options", [])
+    if t == "number":
+        default = float(f.get("default", 0.0))
+    elif t == "select":
+        default = f.get("default", opts[0] if opts else "")
+    else:
+        default = str(f.get("default", ""))
+    idx = opts.index(default) if (opts and default in opts) else 0
+    return (f["key"], t, f["name"], f.get("unit", ""), opts, idx, default)
+
+# поля форм по этапам
+@st.cache_resource(show_spinner=False)
+def step_fields_compiled():
+    step_fields = {
+        "clarify": [
+            {"name":"Температура очищения", "key":"t_clean", "unit":"°C", "type":"number", "default":5.0},
+            {"name":"Кислотность", "key":"acid_T", "unit":"°Т", "type":"number"},
+            {"name":"Сорт молока", "key":"grade", "type":"select", "options":["Высший","1","2","3"], "default":"Высший"},
+        ],
+        "pasteurization": [
+            {"name":"Фактическая T пастеризации", "key":"t_past", "unit":"°C", "type":"number"},
+            {"name":"Время выдержки", "key":"time_hold", "unit":"мин", "type":"number"},
+        ],
+        "cool_to_inoc": [
+            {"name":"T заквашивания", "key":"t_inoc", "unit":"°C", "type":"number"},
+        ],
+        "inoculation": [
+            {"name":"Доза закваски", "key":"dose_culture", "unit":"%", "type":"number"},
+        ],
+        "fermentation": [
+            {"name":"T сквашивания", "key":"t_ferm", "unit":"°C", "type":"number"},
+            {"name":"Время сквашивания", "key":"time_ferm", "unit":"ч", "type":"number"},
+        ],
+        "salt": [
+            {"name":"Соль", "key":"salt_pct", "unit":"%", "type":"number", "default":1.8},
+        ],
+        "mix_water": [
+            {"name":"Доля воды", "key":"water_pct", "unit":"%", "type":"number"},
+        ],
+        "cooling": [
+            {"name":"Температура охлаждения", "key":"t_cool", "unit":"°C", "type":"number"},
+        ],
+        "rennet": [
+            {"name":"Количество фермента", "key":"rennet_ml", "unit":"мл/100л", "type":"number"},
+        ],
+        "press": [
+            {"name":"Давление/время", "key":"press_params", "unit":"", "type":"text"},
+        ],
+    }
+    return {sel: tuple(_compile_field(f) for f in fields) for sel, fields in step_fields.items()}
+
 
 # ---------------------------
 # --- UI стили (спокойная палитра) ---
@@ -310,11 +687,8 @@ PRODUCT_COLORS = {
 }
 
 def color_for_step(step_id):
-    sid = str(step_id).lower()
-    for k,v in STEP_COLORS.items():
-        if k in sid:
-            return v
-    return "#e5e7eb"
+    # id этапов из _stage уже канонические — достаточно прямого поиска в словаре
+    return STEP_COLORS.get(step_id, "#e5e7eb")
 
 def color_for_product(product_id):
     return PRODUCT_COLORS.get(product_id, "linear-gradient(135deg,#f9fafb 0%,#eef2f7 100%)")
@@ -372,8 +746,8 @@ if u is not None:
         try:
             Path(dest).write_bytes(content)
             st.sidebar.success(f"Сохранён {dest.name}")
+            parquet_sidecar(dest).unlink(missing_ok=True)
             st.cache_data.clear()
-            products, samples, measurements, vitamins, storage = load_csvs()
             st.rerun()
         except Exception as e:
             st.sidebar.error(f"Ошибка записи: {e}")
@@ -391,6 +765,13 @@ else:
 st.sidebar.markdown("---")
 st.sidebar.markdown("Версия: 2.1 — dynamic Product page")
 
+def merge_fixed_products(fixed_products):
+    """Строки из Products.csv поверх встроенного списка (одним reindex по product_id)."""
+    if products_indexed.empty:
+        return fixed_products
+    chosen = products_indexed.reindex([fp["product_id"] for fp in fixed_products]).to_dict("records")
+    return [row if pd.notna(row["product_id"]) else fp for row, fp in zip(chosen, fixed_products)]
+
 def goto_product(pid: int):
     st.session_state['selected_product'] = int(pid)
     st.session_state['page'] = 'Продукт'
@@ -399,6 +780,127 @@ def goto_product(pid: int):
     st.rerun()
 
 
+# ---------------------------
+# --- Данные аналитики ---
+# ---------------------------
+# таблицы только читаются (st.dataframe и графики их не меняют): общий объект, без pickle на каждом вызове
+@st.cache_resource(show_spinner=False)
+def airan_tables():
+    data_D1 = {
+        "Группа": ["Контроль", "Опыт 1 (добавка 1)", "Опыт 2 (добавка 2)"],
+        "pH": [3.69, 3.65, 3.51],
+        "°T": [91, 92, 97],
+        "LAB (КОЕ/см³)": [1.2e6, 1.6e6, 2.1e6],
+    }
+    df_D1 = pd.DataFrame(data_D1)
+    df_D1["log10(LAB)"] = np.log10(df_D1["LAB (КОЕ/см³)"].astype(float))
+
+    data_D2 = {
+        "Группа": ["Контроль", "Опыт 1", "Опыт 2"],
+        "Белок %": [1.96, 2.05, 2.23],
+        "Углеводы %": [2.73, 3.06, 3.85],
+        "Жир %": [2.05, 1.93, 2.71],
+        "Влага %": [92.56, 92.26, 90.40],
+        "АОА вод. (мг/г)": [0.10, 0.15, 0.12],
+        "АОА жир (мг/г)": [0.031, 0.043, 0.041],
+        "VitC (мг/100г)": [0.880, 0.904, 0.897],
+    }
+    df_D2 = pd.DataFrame(data_D2)
+    return df_D1, df_D2
+
+# динамика pH (2–10 ч): время, контроль, опыт 1, опыт 2
+PH_TIME = np.array([2, 4, 6, 8, 10])
+PH_CONTROL = np.array([4.515, 4.433, 4.386, 4.352, 4.325])
+PH_EXP1 = np.array([4.464, 4.394, 4.352, 4.323, 4.300])
+PH_EXP2 = np.array([4.419, 4.333, 4.282, 4.246, 4.218])
+
+# точки для моделирования pH
+PH_FIT_T = np.array([1, 2, 3, 4, 5, 6, 8, 10], dtype=float)
+PH_FIT_EXP = np.array([4.65, 4.50, 4.33, 4.20, 4.05, 3.90, 3.78, 3.70], dtype=float)
+
+# моделирование pH: логарифмическая и гиперболическая модели (кешируем только подгонку polyfit)
+@st.cache_data(show_spinner=False)
+def ph_models():
+    t_fit, pH_exp = PH_FIT_T, PH_FIT_EXP
+    ln_t = np.log(t_fit)
+    c1_, c0_ = np.polyfit(ln_t, pH_exp, 1)  # y = c1*ln(t) + c0
+    alpha = c0_; beta = -c1_
+    inv_t = 1.0 / t_fit
+    m, a_intercept = np.polyfit(inv_t, pH_exp, 1)  # y = m*(1/t) + a
+    a = a_intercept; b = m
+    t_pred = np.linspace(1, 10, 100)
+    return t_pred, alpha - beta * np.log(t_pred), a + b / t_pred
+
+# ---------------------------
+# --- Графики аналитики (рендерятся в PNG один раз на процесс) ---
+# ---------------------------
+def _fig_png(fig) -> bytes:
+    # поля заданы subplots_adjust, поэтому без tight-bbox; в кеше лежат готовые байты, а не живой Figure.
+    # Figure создаём напрямую, минуя pyplot: его глобальный реестр фигур общий для потоков сессий
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=200)
+    return buf.getvalue()
+
+@st.cache_resource(show_spinner=False)
+def build_d1_png():
+    df_D1, _ = airan_tables()
+    fig = Figure(figsize=(8,5)); ax1 = fig.subplots()
+    ax1.bar(df_D1["Группа"], df_D1["pH"])
+    ax1.set_ylabel("pH"); ax1.set_title("D1 (7 суток): кислотность и рост LAB")
+    ax2 = ax1.twinx(); ax2.plot(df_D1["Группа"], df_D1["log10(LAB)"], marker="o", linewidth=2)
+    ax2.set_ylabel("log10(LAB)")
+    fig.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.12)
+    return _fig_png(fig)
+
+@st.cache_resource(show_spinner=False)
+def build_d2_composition_png():
+    _, df_D2 = airan_tables()
+    fig = Figure(figsize=(8,5)); ax = fig.subplots()
+    # группы по оси X, показатели — столбцы рядом; один вызов вместо цикла по показателям
+    df_D2.set_index("Группа")[["Белок %", "Углеводы %", "Жир %"]].plot.bar(ax=ax, width=0.8, rot=0)
+    ax.set_xlabel("")
+    ax.set_ylabel("Процент содержания (%)"); ax.set_title("D2 (14 суток): состав айрана"); ax.legend()
+    fig.subplots_adjust(left=0.1, right=0.95, top=0.9, bottom=0.12)
+    return _fig_png(fig)
+
+@st.cache_resource(show_spinner=False)
+def build_d2_functional_png():
+    _, df_D2 = airan_tables()
+    fig = Figure(figsize=(12,5)); axes = fig.subplots(1, 2)
+    axes[0].bar(df_D2["Группа"], df_D2["АОА вод. (мг/г)"])
+    axes[0].set_title("АОА (водная фаза)"); axes[0].set_ylabel("АОА, мг/г")
+    axes[1].bar(df_D2["Группа"], df_D2["VitC (мг/100г)"])
+    axes[1].set_title("Витамин C"); axes[1].set_ylabel("VitC, мг/100г")
+    fig.suptitle("D2: функциональные свойства", fontsize=14)
+    fig.subplots_adjust(left=0.07, right=0.97, top=0.84, bottom=0.12, wspace=0.25)
+    return _fig_png(fig)
+
+@st.cache_resource(show_spinner=False)
+def build_ph_dynamics_png():
+    fig = Figure(figsize=(8,5)); ax0 = fig.subplots()
+    ax0.plot(PH_TIME, PH_CONTROL, 'o-', label='Контроль')
+    ax0.plot(PH_TIME, PH_EXP1, 's-', label='Опыт 1')
+    ax0.plot(PH_TIME, PH_EXP2, '^-', label='Опыт 2')
+    ax0.set_xlabel('Время ферментации, ч'); ax0.set_ylabel('pH')
+    ax0.set_title('Сравнение динамики pH (2–10 ч)')
+    ax0.grid(True, alpha=0.3); ax0.legend()
+    fig.subplots_adjust(left=0.1, right=0.95, top=0.9, bottom=0.12)
+    return _fig_png(fig)
+
+@st.cache_resource(show_spinner=False)
+def build_ph_models_png():
+    t_pred, pH_log_pred, pH_inv_pred = ph_models()
+    fig = Figure(figsize=(8,5)); ax1 = fig.subplots()
+    ax1.scatter(PH_FIT_T, PH_FIT_EXP, color='black', label='Экспериментальные точки')
+    ax1.plot(t_pred, pH_log_pred, label='Логарифмическая  pH = α - β ln(t)')
+    ax1.plot(t_pred, pH_inv_pred, linestyle='--', label='Гиперболическая  pH = a + b/t')
+    ax1.set_xlabel('Время, ч'); ax1.set_ylabel('pH'); ax1.grid(True, alpha=0.3)
+    ax1.set_title('Моделирование динамики pH при ферментации айрана')
+    ax1.legend()
+    fig.subplots_adjust(left=0.1, right=0.95, top=0.9, bottom=0.12)
+    return _fig_png(fig)
+
+
 # ---------------------------
 # --- MAIN: Главная ---
 # ---------------------------
@@ -413,23 +915,8 @@ if st.session_state['page'] == 'Главная':
     )
     st.markdown("---")
 
-    # ---------- Исходные продукты ----------
-    fixed_products = [
-        {"product_id": 1, "name": "Молоко (коровье)",       "type": "Молоко",        "source": "Коровье", "description": "Свежее пастеризованное молоко"},
-        {"product_id": 2, "name": "Молоко (козье)",         "type": "Молоко",        "source": "Козье",   "description": "Натуральное фермерское козье молоко"},
-        {"product_id": 3, "name": "Сары ірімшік (коровье)", "type": "Сыр",           "source": "Коровье", "description": "Твёрдый сыр традиционной выработки"},
-        {"product_id": 4, "name": "Сары ірімшік (козье)",   "type": "Сыр",           "source": "Козье",   "description": "Твёрдый сыр из козьего молока"},
-        {"product_id": 5, "name": "Айран",                  "type": "Кисломолочный", "source": "Коровье", "description": "Освежающий кисломолочный продукт"},
-    ]
-
     # ---------- Подготовка данных ----------
-    display_products = []
-    if not products.empty and 'product_id' in products.columns:
-        for fp in fixed_products:
-            match = products[products['product_id'] == fp['product_id']]
-            display_products.append(match.iloc[0].to_dict() if not match.empty else fp)
-    else:
-        display_products = fixed_products
+    display_products = merge_fixed_products(FIXED_PRODUCTS)
 
     # ---------- Стили карточек + кнопки-обёртки ----------
     st.markdown(
@@ -455,6 +942,8 @@ if st.session_state['page'] == 'Главная':
           .product-meta { font-size: 0.9rem; color: #374151; margin-bottom: 8px; }
           .product-desc { font-size: 0.92rem; color: #4b5563; margin-bottom: 0; }
 
+          .product-grid { display: grid; grid-template-columns: repeat(2, minmax(0, 1fr)); column-gap: 16px; }
+
           form.card-form { margin: 0; }
           button.card-btn { all: unset; display: block; width: 100%; cursor: pointer; }
           button.card-btn:focus { outline: 2px solid #2563eb; outline-offset: 4px; border-radius: 12px; }
@@ -465,7 +954,6 @@ if st.session_state['page'] == 'Главная':
 
     # ---------- Отрисовка карточек (вся карточка = submit) ----------
     st.subheader("Наши продукты")
-    cols = st.columns(2)
 
     def gradient_for(pid):
         gradients = [
@@ -477,25 +965,25 @@ if st.session_state['page'] == 'Главная':
         ]
         return gradients[(pid - 1) % len(gradients)]
 
-    for i, p in enumerate(display_products):
-        pid = int(p["product_id"]) 
+    # все карточки — одним st.markdown (CSS-сетка в 2 колонки)
+    html_parts = []
+    for p in display_products:
+        pid = int(p["product_id"])
         grad = gradient_for(pid)
-
-        card_html = f"""
-        <form class="card-form" method="get">
-          <input type="hidden" name="goto" value="product"/>
-          <input type="hidden" name="pid" value="{pid}"/>
-          <button class="card-btn" type="submit" aria-label="Открыть {p["name"]}">
-            <div class="product-card" style="background: {grad};">
-                <div class="product-title">{p["name"]}</div>
-                <div class="product-meta">Тип: {p["type"]} • Источник: {p["source"]}</div>
-                <div class="product-desc">{p["description"]}</div>
-            </div>
-          </button>
-        </form>
-        """
-        with cols[i % 2]:
-            st.markdown(card_html, unsafe_allow_html=True)
+        html_parts.append(
+            f'<form class="card-form" method="get">'
+            f'<input type="hidden" name="goto" value="product"/>'
+            f'<input type="hidden" name="pid" value="{pid}"/>'
+            f'<button class="card-btn" type="submit" aria-label="Открыть {p["name"]}">'
+            f'<div class="product-card" style="background: {grad};">'
+            f'<div class="product-title">{p["name"]}</div>'
+            f'<div class="product-meta">Тип: {p["type"]} • Источник: {p["source"]}</div>'
+            f'<div class="product-desc">{p["description"]}</div>'
+            f'</div>'
+            f'</button>'
+            f'</form>'
+        )
+    st.markdown(f'<div class="product-grid">{"".join(html_parts)}</div>', unsafe_allow_html=True)
 
     # ---------- Обработка параметров (в этой же странице) ----------
     try:
@@ -525,79 +1013,23 @@ if st.session_state['page'] == 'Главная':
 # ---------------------------
 elif st.session_state['page'] == 'Продукт':
 
-    # --- Генератор этапа ---
-    def _stage(id, label, desc="", norm=None):
-        return (id, label, desc, norm or {})
-
-    # --- Правильная логика этапов по продукту (с учётом source) ---
-    def _product_steps(prod: dict):
-        name = str(prod.get('name', '')).strip()
-        source = str(prod.get('source', '')).strip()
-
-        nlow = name.lower()
-        slow = source.lower()
-
-        is_ayran  = "айран" in nlow
-        is_cheese = ("ірімшік" in nlow) or ("сыр" in nlow)
-        is_milk   = ("молоко" in nlow)
-
-        goat = (
-            ("козье" in nlow) or ("козий" in nlow) or ("goat" in nlow) or ("ешкі" in nlow) or
-            ("козье" in slow) or ("козий" in slow) or ("goat" in slow) or ("ешкі" in slow)
-        )
-
-        common = [
-            _stage("accept", "Приёмка сырья", "Осмотр тары, органолептика, экспресс-анализ состава/обсеменённости."),
-            _stage("clarify", "Очистка и сортировка (4–6 °C)", "Фильтрация/сепараторы. Оценка чистоты, кислотности (°Т), определение сорта.",
-                   {"min": 4, "max": 6, "unit": "°C", "note": "Охлаждение до 4–6 °C замедляет рост бактерий"}),
-            _stage("normalization", "Нормализация состава", "Приведение к нормам по жирности/белку/витаминам/минералам."),
-        ]
-
-        need_homogenization = (is_ayran or (is_milk and not goat) or (is_cheese and not goat))
-        if need_homogenization:
-            common.append(_stage("homogenization", "Гомогенизация", "Дробление жировых шариков → однородность, отсутствие отстоя."))
-
-        common.append(_stage(
-            "pasteurization", "Пастеризация (65–69 °C)", "Термообработка для снижения микрофлоры.",
-            {"min": 65, "max": 69, "unit": "°C", "note": "Пастеризация согласно рецептуре/ГОСТ"}
-        ))
-
-        if is_ayran:
-            tail = [
-                _stage("cool_to_inoc", "Охлаждение до заквашивания (35–45 °C)", "Перед внесением закваски.", {"min": 35, "max": 45, "unit": "°C"}),
-                _stage("inoculation", "Внесение закваски", "Культуры: стрептококк, болгарская палочка, дрожжи."),
-                _stage("fermentation", "Сквашивание (20–25 °C)", "Выдержка при заданной температуре.", {"min": 20, "max": 25, "unit": "°C"}),
-                _stage("salt", "Добавление соли (1.5–2%)", "Перемешать до однородности."),
-                _stage("mix_water", "Смешивание с водой / газирование", "Смешивание с кипячёной водой, газирование."),
-                _stage("mature", "Созревание в бутылках (холод)", "Холодильное созревание."),
-                _stage("label", "Розлив/упаковка/маркировка", "Готовый продукт."),
-            ]
-        elif is_cheese:
-            tail = [
-                _stage("prep_cheese", "Подготовка к выработке", "Коррекция состава/кальций/закваски."),
-                _stage("rennet", "Сычужное свертывание", "Внесение фермента → образование сгустка."),
-                _stage("curd", "Обработка сгустка", "Резка/нагрев/перемешивание → выделение сыворотки."),
-                _stage("form", "Формование", "Выкладка в формы."),
-                _stage("press", "Самопрессование/прессование", "Осушка и уплотнение структуры."),
-                _stage("salt_dry", "Посолка/обсушка", "Рассол/сухая посолка; обсушка 2–3 суток (10–12 °C)."),
-                _stage("ripen", "Созревание", "Камеры с контролем температуры и влажности."),
-                _stage("label", "Упаковка/хранение/реализация", "Контроль качества и выпуск."),
-            ]
-        else:
-            tail = [
-                _stage("cooling", "Охлаждение (2–6 °C)", "Быстрое охлаждение после пастеризации.", {"min": 2, "max": 6, "unit": "°C"}),
-                _stage("steril", "Стерилизация / UHT", "Безопасность и длительный срок хранения."),
-                _stage("label", "Розлив/упаковка/маркировка", "Готовый продукт."),
-            ]
-
-        return common + tail
+    def measurements_for_samples(prod_samples):
+        if prod_samples.empty or 'sample_id' not in prod_samples.columns:
+            return pd.DataFrame()
+        # строки берём из готового индекса sample_id -> позиции, без isin-скана;
+        # unique() — чтобы повтор sample_id в Samples не дублировал измерения
+        parts = [meas_idx_by_sample[sid] for sid in prod_samples['sample_id'].unique() if sid in meas_idx_by_sample]
+        return measurements.iloc[np.concatenate(parts)] if parts else pd.DataFrame()
 
     # --- Рендер карточки этапа ---
-    def render_step_card(sid, label, desc, color):
+    def render_step_card(sid, label, desc, color, arrow=False):
         active = (st.session_state.get('selected_step') == sid)
         bg = "#EEF2F7" if active else "white"
+        # стрелка от предыдущего этапа идёт в том же st.markdown, что и карточка
+        arrow_html = '<div class="arrow">↓</div>' if arrow else ''
         st.markdown(
             f"""
+            {arrow_html}
             <div class="step-card" style="border-left:4px solid {color}; background:{bg}">
               <div class="step-title">{label}</div>
               <div class="step-desc">{desc}</div>
@@ -607,44 +1039,6 @@ elif st.session_state['page'] == 'Продукт':
         )
         return st.button(("Выбран: " if active else "Выбрать этап: ") + f"{label}", key=f"btn_{sid}", use_container_width=True)
 
-    # --- Поля форм по этапам ---
-    STEP_FIELDS = {
-        "clarify": [
-            {"name":"Температура очищения", "key":"t_clean", "unit":"°C", "type":"number", "default":5.0},
-            {"name":"Кислотность", "key":"acid_T", "unit":"°Т", "type":"number"},
-            {"name":"Сорт молока", "key":"grade", "type":"select", "options":["Высший","1","2","3"], "default":"Высший"},
-        ],
-        "pasteurization": [
-            {"name":"Фактическая T пастеризации", "key":"t_past", "unit":"°C", "type":"number"},
-            {"name":"Время выдержки", "key":"time_hold", "unit":"мин", "type":"number"},
-        ],
-        "cool_to_inoc": [
-            {"name":"T заквашивания", "key":"t_inoc", "unit":"°C", "type":"number"},
-        ],
-        "inoculation": [
-            {"name":"Доза закваски", "key":"dose_culture", "unit":"%", "type":"number"},
-        ],
-        "fermentation": [
-            {"name":"T сквашивания", "key":"t_ferm", "unit":"°C", "type":"number"},
-            {"name":"Время сквашивания", "key":"time_ferm", "unit":"ч", "type":"number"},
-        ],
-        "salt": [
-            {"name":"Соль", "key":"salt_pct", "unit":"%", "type":"number", "default":1.8},
-        ],
-        "mix_water": [
-            {"name":"Доля воды", "key":"water_pct", "unit":"%", "type":"number"},
-        ],
-        "cooling": [
-            {"name":"Температура охлаждения", "key":"t_cool", "unit":"°C", "type":"number"},
-        ],
-        "rennet": [
-            {"name":"Количество фермента", "key":"rennet_ml", "unit":"мл/100л", "type":"number"},
-        ],
-        "press": [
-            {"name":"Давление/время", "key":"press_params", "unit":"", "type":"text"},
-        ],
-    }
-
     pid = st.session_state.get('selected_product', None)
     if pid is None:
         st.info("Выберите продукт на главной странице.")
@@ -652,10 +1046,8 @@ elif st.session_state['page'] == 'Продукт':
             st.session_state['page'] = 'Главная'; st.rerun()
     else:
         prod = None
-        if not products.empty and 'product_id' in products.columns:
-            m = products[products['product_id'] == int(pid)]
-            if not m.empty:
-                prod = m.iloc[0].to_dict()
+        if int(pid) in products_indexed.index:
+            prod = products_indexed.loc[int(pid)].to_dict()
         if prod is None:
             names = {1:"Молоко (коровье)",2:"Молоко (козье)",3:"Сары ірімшік (коровье)",4:"Сары ірімшік (козье)",5:"Айран"}
             prod = {"product_id":pid,"name":names.get(pid,f"Продукт {pid}"),"type":"-","source":"-","description":""}
@@ -701,15 +1093,15 @@ elif st.session_state['page'] == 'Продукт':
         st.markdown("---")
         st.subheader("Процесс изготовления (кликабельные этапы)")
 
-        steps = _product_steps(prod)
+        steps = steps_by_pid().get(int(pid))
+        if steps is None:
+            steps = _product_steps_cached(int(pid), str(prod.get('name', '')), str(prod.get('source', '')))
         for idx, (sid, label, desc, norm) in enumerate(steps):
             color = color_for_step(sid)
-            if render_step_card(sid, label, desc, color):
+            if render_step_card(sid, label, desc, color, arrow=idx > 0):
                 st.session_state['selected_step'] = sid
                 st.session_state['selected_step_label'] = label
                 st.rerun()
-            if idx < len(steps) - 1:
-                st.markdown('<div class="arrow">↓</div>', unsafe_allow_html=True)
 
         # --- Детали выбранного этапа ---
         if st.session_state.get('selected_step'):
@@ -728,25 +1120,17 @@ elif st.session_state['page'] == 'Продукт':
                     st.caption(norm['note'])
 
             st.write("**Журнал партий для продукта:**")
-            if 'product_id' in samples.columns:
-                prod_samples = samples[samples['product_id'] == int(pid)].copy()
-            else:
-                prod_samples = pd.DataFrame()
+            prod_samples = samples.iloc[samples_idx_by_product.get(int(pid), [])]
             if prod_samples.empty:
                 st.info("Партии для этого продукта отсутствуют. Добавьте партию ниже.")
             else:
                 st.dataframe(prod_samples.sort_values(by='date_received', ascending=False).reset_index(drop=True))
 
             st.write("**Измерения (Measurements):**")
-            if 'sample_id' in measurements.columns and not prod_samples.empty:
-                rel = measurements[measurements['sample_id'].isin(prod_samples['sample_id'])].copy()
-            else:
-                rel = pd.DataFrame()
+            rel = measurements_for_samples(prod_samples)
             if rel.empty:
                 st.info("Нет измерений для этих партий.")
             else:
-                if 'actual_numeric' not in rel.columns and 'actual_value' in rel.columns:
-                    rel['actual_numeric'] = rel['actual_value'].apply(parse_numeric)
                 st.dataframe(rel[['sample_id','parameter','unit','actual_value','actual_numeric']].reset_index(drop=True))
 
             st.markdown("### Сохранить параметры этапа")
@@ -754,22 +1138,16 @@ elif st.session_state['page'] == 'Продукт':
                 sample_opts = prod_samples['sample_id'].tolist() if not prod_samples.empty else []
                 sample_choice = st.selectbox("Sample ID", options=sample_opts) if sample_opts else None
                 vals = {}
-                fields = STEP_FIELDS.get(sel, [])
+                fields = step_fields_compiled().get(sel, ())
                 c1, c2 = st.columns(2)
-                for i, f in enumerate(fields):
+                for i, (key, t, label_f, unit, opts, idx, default) in enumerate(fields):
                     with (c1 if i % 2 == 0 else c2):
-                        t = f.get("type","text")
-                        label_f = f["name"]
-                        key = f["key"]
                         if t == "number":
-                            vals[key] = st.number_input(f"{label_f} ({f.get('unit','')})", value=float(f.get("default", 0.0)))
+                            vals[key] = st.number_input(f"{label_f} ({unit})", value=default)
                         elif t == "select":
-                            opts = f.get("options", [])
-                            default = f.get("default", opts[0] if opts else "")
-                            idx = opts.index(default) if (opts and default in opts) else 0
                             vals[key] = st.selectbox(label_f, options=opts, index=idx)
                         else:
-                            vals[key] = st.text_input(label_f, value=str(f.get("default","")))
+                            vals[key] = st.text_input(label_f, value=default)
                 save_params = st.form_submit_button("Сохранить параметры")
 
             if save_params:
@@ -777,39 +1155,41 @@ elif st.session_state['page'] == 'Продукт':
                     st.error("Сначала добавьте партию.")
                 else:
                     try:
-                        base_id = int(datetime.now().timestamp())
+                        # id подряд от текущего максимума (measurements общий для всех сессий и
+                        # перечитывается после каждого сохранения), без коллизий при двух сохранениях в секунду
+                        mx = pd.to_numeric(measurements.get('id', pd.Series(dtype='Int64')), errors='coerce').max()
+                        id_counter = itertools.count((0 if pd.isna(mx) else int(mx)) + 1)
                         rows = []
-                        for j, f in enumerate(fields):
-                            par_name = f"{sel_label}: {f['name']}"
+                        for key, _, label_f, unit, *_ in fields:
+                            par_name = f"{sel_label}: {label_f}"
                             rows.append({
-                                "id": base_id + j,
+                                "id": next(id_counter),
                                 "sample_id": int(sample_choice),
                                 "parameter": par_name,
-                                "unit": f.get("unit",""),
-                                "actual_value": str(vals.get(f['key'],"")),
+                                "unit": unit,
+                                "actual_value": str(vals.get(key,"")),
                                 "method": "этап/форма"
                             })
                         if rows:
-                            df_append = pd.DataFrame(rows)
-                            write_header = not MEASUREMENTS_CSV.exists() or MEASUREMENTS_CSV.stat().st_size == 0
-                            df_append.to_csv(MEASUREMENTS_CSV, mode='a', index=False, header=write_header, encoding='utf-8-sig')
-                            st.cache_data.clear()
-                            products, samples, measurements, vitamins, storage = load_csvs()
+                            append_row_csv(MEASUREMENTS_CSV, rows, cols_order=["id","sample_id","parameter","unit","actual_value","method"])
+                            load_measurements.clear()
+                            measurements, meas_idx_by_sample = load_measurements()
                             st.success("Параметры этапа сохранены.")
                     except Exception as e:
                         st.error(f"Ошибка сохранения: {e}")
 
             st.markdown("### Добавить новую партию (Sample)")
             with st.form(f"form_add_sample_{pid}", clear_on_submit=True):
-                try:
-                    existing = pd.to_numeric(samples.get('sample_id', pd.Series(dtype='Int64')), errors='coerce').dropna()
-                    new_sid = int(existing.max()) + 1 if not existing.empty else 1
-                except Exception:
-                    new_sid = 1
+                new_sid = next_sample_id
+                # значения по умолчанию считаем один раз: рег. номер — на каждый новый id, дата — до сохранения партии
+                if st.session_state.get('reg_number_default', (None, ""))[0] != new_sid:
+                    st.session_state['reg_number_default'] = (new_sid, f"A-{new_sid:03d}")
+                if 'date_received_default' not in st.session_state:
+                    st.session_state['date_received_default'] = datetime.now().date()
                 c1, c2 = st.columns(2)
                 with c1:
-                    reg_number = st.text_input("Рег. номер", value=f"A-{new_sid:03d}")
-                    date_received = st.date_input("Дата поступления", value=datetime.now().date())
+                    reg_number = st.text_input("Рег. номер", value=st.session_state['reg_number_default'][1])
+                    date_received = st.date_input("Дата поступления", value=st.session_state['date_received_default'])
                     storage_days = st.number_input("Срок хранения, дни", min_value=0, value=0)
                 with c2:
                     temp_input = st.number_input("Температура (°C)", value=21.0, format="%.2f")
@@ -829,8 +1209,9 @@ elif st.session_state['page'] == 'Продукт':
                 }
                 try:
                     append_row_csv(SAMPLES_CSV, row, cols_order=["sample_id","product_id","reg_number","date_received","storage_days","conditions","notes"])
-                    st.cache_data.clear()
-                    products, samples, measurements, vitamins, storage = load_csvs()
+                    load_samples.clear()
+                    samples, samples_idx_by_product, next_sample_id = load_samples()
+                    st.session_state.pop('date_received_default', None)
                     st.success("Партия добавлена.")
                 except Exception as e:
                     st.error(f"Ошибка: {e}")
@@ -838,14 +1219,13 @@ elif st.session_state['page'] == 'Продукт':
         st.markdown("---")
         st.subheader("Измерения по продукту")
         if 'product_id' in samples.columns and 'sample_id' in measurements.columns:
-            prod_samples = samples[samples['product_id'] == int(pid)]
-            rel = measurements[measurements['sample_id'].isin(prod_samples['sample_id'])] if not prod_samples.empty else pd.DataFrame()
+            prod_samples = samples.iloc[samples_idx_by_product.get(int(pid), [])]
+            rel = measurements_for_samples(prod_samples)
             if rel.empty:
                 st.info("Измерений пока нет.")
             else:
-                if 'actual_numeric' not in rel.columns and 'actual_value' in rel.columns:
-                    rel['actual_numeric'] = rel['actual_value'].apply(parse_numeric)
-                st.dataframe(rel.sort_values(by='sample_id', ascending=False).reset_index(drop=True), use_container_width=True)
+                # 200 строк с наибольшим sample_id: частичный отбор вместо полной сортировки
+                st.dataframe(rel.nlargest(200, 'sample_id'), use_container_width=True, hide_index=True)
         else:
             st.info("Данных пока нет.")
 
@@ -857,7 +1237,6 @@ elif st.session_state['page'] == 'Продукт':
         with c2:
             if st.button("Обновить страницу", use_container_width=True):
                 st.cache_data.clear()
-                products, samples, measurements, vitamins, storage = load_csvs()
                 st.rerun()
 
 
@@ -873,20 +1252,7 @@ elif st.session_state['page'] == 'Модели и аналитика':
         st.session_state['analytics_selected_product'] = None
 
     # список продуктов (как на Главной)
-    fixed_products = [
-        {"product_id": 1, "name": "Молоко (коровье)",       "type": "Молоко",        "source": "Коровье", "description": "Свежее пастеризованное молоко"},
-        {"product_id": 2, "name": "Молоко (козье)",         "type": "Молоко",        "source": "Козье",   "description": "Натуральное фермерское козье молоко"},
-        {"product_id": 3, "name": "Сары ірімшік (коровье)", "type": "Сыр",           "source": "Коровье", "description": "Твёрдый сыр традиционной выработки"},
-        {"product_id": 4, "name": "Сары ірімшік (козье)",   "type": "Сыр",           "source": "Козье",   "description": "Твёрдый сыр из козьего молока"},
-        {"product_id": 5, "name": "Айран",                  "type": "Кисломолочный", "source": "Коровье", "description": "Освежающий кисломолочный продукт"},
-    ]
-    display_products = []
-    if not products.empty and 'product_id' in products.columns:
-        for fp in fixed_products:
-            match = products[products['product_id'] == fp['product_id']]
-            display_products.append(match.iloc[0].to_dict() if not match.empty else fp)
-    else:
-        display_products = fixed_products
+    display_products = merge_fixed_products(FIXED_PRODUCTS)
 
     # стили карточек
     st.markdown(
@@ -936,31 +1302,13 @@ elif st.session_state['page'] == 'Модели и аналитика':
         st.header("Айран — аналитика и модели")
 
         st.subheader("Вводные данные")
+        df_D1, df_D2 = airan_tables()
         c1, c2 = st.columns(2)
 
-        data_D1 = {
-            "Группа": ["Контроль", "Опыт 1 (добавка 1)", "Опыт 2 (добавка 2)"],
-            "pH": [3.69, 3.65, 3.51],
-            "°T": [91, 92, 97],
-            "LAB (КОЕ/см³)": [1.2e6, 1.6e6, 2.1e6],
-        }
-        df_D1 = pd.DataFrame(data_D1)
-        df_D1["log10(LAB)"] = np.log10(df_D1["LAB (КОЕ/см³)"].astype(float))
         with c1:
             st.markdown("**Таблица 4. D1 — Айран (7 суток)**")
             st.dataframe(df_D1, use_container_width=True)
 
-        data_D2 = {
-            "Группа": ["Контроль", "Опыт 1", "Опыт 2"],
-            "Белок %": [1.96, 2.05, 2.23],
-            "Углеводы %": [2.73, 3.06, 3.85],
-            "Жир %": [2.05, 1.93, 2.71],
-            "Влага %": [92.56, 92.26, 90.40],
-            "АОА вод. (мг/г)": [0.10, 0.15, 0.12],
-            "АОА жир (мг/г)": [0.031, 0.043, 0.041],
-            "VitC (мг/100г)": [0.880, 0.904, 0.897],
-        }
-        df_D2 = pd.DataFrame(data_D2)
         with c2:
             st.markdown("**Таблица 5. D2 — Айран (14 суток)**")
             st.dataframe(df_D2, use_container_width=True)
@@ -970,72 +1318,15 @@ elif st.session_state['page'] == 'Модели и аналитика':
         tab1, tab2, tab3 = st.tabs(["D1: кислотность и LAB", "D2: состав и свойства", "Моделирование pH"])
 
         with tab1:
-            fig, ax1 = plt.subplots(figsize=(8,5))
-            ax1.bar(df_D1["Группа"], df_D1["pH"])
-            ax1.set_ylabel("pH"); ax1.set_title("D1 (7 суток): кислотность и рост LAB")
-            ax2 = ax1.twinx(); ax2.plot(df_D1["Группа"], df_D1["log10(LAB)"], marker="o", linewidth=2)
-            ax2.set_ylabel("log10(LAB)")
-            st.pyplot(fig, use_container_width=True)
+            st.image(build_d1_png(), width="stretch")
 
         with tab2:
-            df_comp = df_D2.melt(id_vars="Группа",
-                                 value_vars=["Белок %", "Углеводы %", "Жир %"],
-                                 var_name="Показатель", value_name="Значение")
-            fig1, ax = plt.subplots(figsize=(8,5))
-            groups = df_comp["Группа"].unique()
-            cats = df_comp["Показатель"].unique()
-            x = np.arange(len(groups))
-            width = 0.8 / len(cats)
-            for i, cat in enumerate(cats):
-                vals = df_comp[df_comp["Показатель"] == cat]["Значение"].values
-                ax.bar(x + i*width - (len(cats)-1)*width/2, vals, width=width, label=cat)
-            ax.set_xticks(x); ax.set_xticklabels(groups)
-            ax.set_ylabel("Процент содержания (%)"); ax.set_title("D2 (14 суток): состав айрана"); ax.legend()
-            st.pyplot(fig1, use_container_width=True)
-
-            fig2, axes = plt.subplots(1, 2, figsize=(12,5))
-            axes[0].bar(df_D2["Группа"], df_D2["АОА вод. (мг/г)"])
-            axes[0].set_title("АОА (водная фаза)"); axes[0].set_ylabel("АОА, мг/г")
-            axes[1].bar(df_D2["Группа"], df_D2["VitC (мг/100г)"])
-            axes[1].set_title("Витамин C"); axes[1].set_ylabel("VitC, мг/100г")
-            plt.suptitle("D2: функциональные свойства", fontsize=14)
-            st.pyplot(fig2, use_container_width=True)
+            st.image(build_d2_composition_png(), width="stretch")
+            st.image(build_d2_functional_png(), width="stretch")
 
         with tab3:
-            time = np.array([2, 4, 6, 8, 10])
-            ph_control = np.array([4.515, 4.433, 4.386, 4.352, 4.325])
-            ph_exp1 = np.array([4.464, 4.394, 4.352, 4.323, 4.300])
-            ph_exp2 = np.array([4.419, 4.333, 4.282, 4.246, 4.218])
-
-            fig0, ax0 = plt.subplots(figsize=(8,5))
-            ax0.plot(time, ph_control, 'o-', label='Контроль')
-            ax0.plot(time, ph_exp1, 's-', label='Опыт 1')
-            ax0.plot(time, ph_exp2, '^-', label='Опыт 2')
-            ax0.set_xlabel('Время ферментации, ч'); ax0.set_ylabel('pH')
-            ax0.set_title('Сравнение динамики pH (2–10 ч)')
-            ax0.grid(True, alpha=0.3); ax0.legend()
-            st.pyplot(fig0, use_container_width=True)
-
-            t_fit = np.array([1, 2, 3, 4, 5, 6, 8, 10], dtype=float)
-            pH_exp = np.array([4.65, 4.50, 4.33, 4.20, 4.05, 3.90, 3.78, 3.70], dtype=float)
-            ln_t = np.log(t_fit)
-            c1_, c0_ = np.polyfit(ln_t, pH_exp, 1)  # y = c1*ln(t) + c0
-            alpha = c0_; beta = -c1_
-            inv_t = 1.0 / t_fit
-            m, a_intercept = np.polyfit(inv_t, pH_exp, 1)  # y = m*(1/t) + a
-            a = a_intercept; b = m
-            t_pred = np.linspace(1, 10, 100)
-            pH_log_pred = alpha - beta * np.log(t_pred)
-            pH_inv_pred = a + b / t_pred
-
-            fig1, ax1 = plt.subplots(figsize=(8,5))
-            ax1.scatter(t_fit, pH_exp, color='black', label='Экспериментальные точки')
-            ax1.plot(t_pred, pH_log_pred, label='Логарифмическая  pH = α - β ln(t)')
-            ax1.plot(t_pred, pH_inv_pred, linestyle='--', label='Гиперболическая  pH = a + b/t')
-            ax1.set_xlabel('Время, ч'); ax1.set_ylabel('pH'); ax1.grid(True, alpha=0.3)
-            ax1.set_title('Моделирование динамики pH при ферментации айрана')
-            ax1.legend()
-            st.pyplot(fig1, use_container_width=True)
+            st.image(build_ph_dynamics_png(), width="stretch")
+            st.image(build_ph_models_png(), width="stretch")
 
     def render_cheese_analytics():
         st.markdown("---")